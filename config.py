@@ -4,10 +4,13 @@
 """
 import os
 from pathlib import Path
-from dotenv import load_dotenv
+from types import MappingProxyType
 
 # Загрузка переменных окружения из .env файла
-load_dotenv()
+# (пропускается, если обязательные переменные уже заданы в окружении процесса)
+if not (os.environ.get("TELEGRAM_BOT_TOKEN") and os.environ.get("ELEVENLABS_API_KEY")):
+    from dotenv import load_dotenv
+    load_dotenv()
 
 # Telegram Bot API
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
@@ -24,7 +27,8 @@ ELEVENLABS_API_URL = "https://api.elevenlabs.io/v1/text-to-speech"
 # Доступные женские голоса с разными тонами (все говорят на русском языке)
 # Все голоса используют мультиязычную модель eleven_multilingual_v2, которая отлично поддерживает русский язык
 # Формат: {"id": "voice_id", "name": "Название", "description": "Описание тона"}
-AVAILABLE_VOICES = {
+# Словарь доступен только для чтения, чтобы его можно было безопасно разделять между обработчиками
+AVAILABLE_VOICES = MappingProxyType({
     "bella": {
         "id": "EXAVITQu4vr4xnSDxMaL",
         "name": "Bella",
@@ -60,10 +64,14 @@ AVAILABLE_VOICES = {
         "name": "Alice",
         "description": "Нежный, мягкий, деликатный (русский)"
     }
-}
+})
+
+# Обратный индекс для быстрого поиска голоса по его ID
+VOICES_BY_ID = MappingProxyType({voice_info["id"]: voice_info for voice_info in AVAILABLE_VOICES.values()})
 
 # Голос по умолчанию
 DEFAULT_VOICE_ID = AVAILABLE_VOICES["bella"]["id"]
+DEFAULT_VOICE_NAME = AVAILABLE_VOICES["bella"]["name"]
 # Опционально: можно указать голос по умолчанию в .env
 FEMALE_VOICE_ID = os.getenv("ELEVENLABS_VOICE_ID", DEFAULT_VOICE_ID)
 
@@ -81,7 +89,15 @@ TTS_MODEL = "eleven_multilingual_v2"  # Мультиязычная модель
 
 # Путь для сохранения аудиофайлов
 AUDIO_DIR = Path("audio")
-AUDIO_DIR.mkdir(exist_ok=True)
+if not AUDIO_DIR.is_dir():
+    AUDIO_DIR.mkdir(parents=True, exist_ok=True)
+
+# Максимальное количество аудиофайлов в AUDIO_DIR (используется как кэш, старые файлы удаляются)
+AUDIO_CACHE_MAX_FILES = 500
+
+# Файл с хэшем последних установленных команд бота
+# (позволяет не обращаться к Telegram при каждом запуске, если команды не менялись)
+COMMANDS_HASH_FILE = AUDIO_DIR.parent / ".commands_hash"
 
 # Максимальная длина текста (символов)
 MAX_TEXT_LENGTH = 5000
@@ -1,12 +1,14 @@
 """
 Основной файл Telegram-бота для озвучивания текста через ElevenLabs
 """
+import asyncio
+import hashlib
 import logging
 from pathlib import Path
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
-from voice import ElevenLabsTTS
-from config import TELEGRAM_BOT_TOKEN, MAX_TEXT_LENGTH, AVAILABLE_VOICES, DEFAULT_VOICE_ID
+from voice import ElevenLabsTTS, close_http_client
+from config import TELEGRAM_BOT_TOKEN, MAX_TEXT_LENGTH, AVAILABLE_VOICES, VOICES_BY_ID, DEFAULT_VOICE_ID, DEFAULT_VOICE_NAME, COMMANDS_HASH_FILE
 
 # Настройка логирования
 logging.basicConfig(
@@ -27,8 +29,73 @@ class TelegramTTSBot:
         BotCommand("status", "Проверить статус API и текущий голос"),
     ]
     
+    # Тексты сообщений формируются один раз при загрузке модуля
+    WELCOME_TEMPLATE = (
+        "🎙️ Привет! Я бот для озвучивания текста на русском языке.\n\n"
+        "📝 Просто отправь мне текст на русском, и я преобразую его в речь с помощью ElevenLabs.\n"
+        "🎤 Текущий голос: {voice_name} - {voice_description}\n"
+        f"⚠️ Максимальная длина текста: {MAX_TEXT_LENGTH} символов.\n\n"
+        "Используй команду /voice для выбора голоса\n"
+        "Используй команду /help для получения дополнительной информации."
+    )
+    
+    HELP_MESSAGE = (
+        "📖 Справка по использованию бота:\n\n"
+        "🔹 Команды:\n"
+        "/start - Начать работу с ботом\n"
+        "/help - Показать эту справку\n"
+        "/voice - Выбрать голос для озвучивания\n"
+        "/status - Проверить статус API\n\n"
+        "💡 Как использовать:\n"
+        "1. Выбери голос командой /voice (все голоса говорят на русском)\n"
+        "2. Отправь мне любой текст на русском языке\n"
+        "3. Я преобразую его в речь выбранным женским голосом\n"
+        "4. Получишь аудиофайл с озвучкой\n"
+        "5. Повторная озвучка того же текста тем же голосом берется из кэша на сервере\n\n"
+        f"⚠️ Ограничения: максимум {MAX_TEXT_LENGTH} символов за раз\n"
+        "🇷🇺 Все голоса поддерживают русский язык"
+    )
+    
     def __init__(self):
-        pass
+        # Клавиатура выбора голоса статична, поэтому строим ее один раз
+        self._voice_keyboard = self._build_voice_keyboard()
+    
+    @staticmethod
+    def _build_voice_keyboard() -> InlineKeyboardMarkup:
+        """Строит inline-клавиатуру со всеми доступными голосами (по 2 кнопки в ряд)"""
+        keyboard = []
+        row = []
+        
+        for i, (key, voice_info) in enumerate(AVAILABLE_VOICES.items()):
+            button_text = f"{voice_info['name']}\n{voice_info['description']}"
+            row.append(InlineKeyboardButton(button_text, callback_data=f"voice_{key}"))
+            
+            if len(row) == 2 or i == len(AVAILABLE_VOICES) - 1:
+                keyboard.append(row)
+                row = []
+        
+        return InlineKeyboardMarkup(keyboard)
+    
+    def _commands_hash(self, bot_id: int) -> str:
+        """Вычисляет хэш набора команд бота для сравнения с сохраненным"""
+        commands = [(cmd.command, cmd.description) for cmd in self.BOT_COMMANDS]
+        return hashlib.sha256(repr((bot_id, commands)).encode()).hexdigest()
+    
+    @staticmethod
+    def _read_commands_hash() -> str:
+        """Читает сохраненный хэш команд (пустая строка, если его нет)"""
+        try:
+            return COMMANDS_HASH_FILE.read_text().strip()
+        except OSError:
+            return ""
+    
+    @staticmethod
+    def _save_commands_hash(commands_hash: str):
+        """Сохраняет хэш актуальных команд бота"""
+        try:
+            COMMANDS_HASH_FILE.write_text(commands_hash)
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить хэш команд бота: {e}")
     
     async def setup_commands(self, application: Application):
         """
@@ -38,9 +105,14 @@ class TelegramTTSBot:
             application: Экземпляр Application бота
         """
         try:
-            import asyncio
             bot = application.bot
             
+            # Если команды не менялись с прошлого запуска, не обращаемся к Telegram
+            commands_hash = self._commands_hash(bot.id)
+            if self._read_commands_hash() == commands_hash:
+                logger.info("✅ Команды бота актуальны (по сохраненному хэшу), обновление не требуется")
+                return
+            
             # Получаем текущие команды бота с таймаутом
             try:
                 current_commands = await asyncio.wait_for(
@@ -56,6 +128,7 @@ class TelegramTTSBot:
                         timeout=10.0
                     )
                     logger.info("Команды бота установлены без проверки")
+                    self._save_commands_hash(commands_hash)
                 except asyncio.TimeoutError:
                     logger.warning("Таймаут при установке команд, пропускаем")
                 return
@@ -67,6 +140,7 @@ class TelegramTTSBot:
                         timeout=10.0
                     )
                     logger.info("Команды бота установлены без проверки")
+                    self._save_commands_hash(commands_hash)
                 except Exception:
                     logger.warning("Не удалось установить команды, пропускаем")
                 return
@@ -113,10 +187,12 @@ class TelegramTTSBot:
                         timeout=10.0
                     )
                     logger.info(f"✅ Команды бота успешно обновлены: {[cmd.command for cmd in self.BOT_COMMANDS]}")
+                    self._save_commands_hash(commands_hash)
                 except asyncio.TimeoutError:
                     logger.warning("Таймаут при установке команд бота, но бот продолжит работу")
             else:
                 logger.info("✅ Команды бота актуальны, обновление не требуется")
+                self._save_commands_hash(commands_hash)
                 
         except asyncio.TimeoutError:
             logger.warning("Таймаут при установке команд бота, но бот продолжит работу")
@@ -127,80 +203,46 @@ class TelegramTTSBot:
     def get_tts_instance(self, context: ContextTypes.DEFAULT_TYPE) -> ElevenLabsTTS:
         """Получает или создает экземпляр TTS с выбранным голосом пользователя"""
         voice_id = context.user_data.get("voice_id", DEFAULT_VOICE_ID)
-        # Создаем новый экземпляр с нужным голосом каждый раз
-        return ElevenLabsTTS(voice_id=voice_id)
+        
+        # Переиспользуем сохраненный экземпляр, если голос не менялся
+        tts = context.user_data.get("_tts")
+        if tts is not None and context.user_data.get("_tts_voice_id") == voice_id:
+            return tts
+        
+        tts = ElevenLabsTTS(voice_id=voice_id)
+        context.user_data["_tts"] = tts
+        context.user_data["_tts_voice_id"] = voice_id
+        return tts
     
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /start"""
         # Инициализация данных пользователя
         context.user_data["user_id"] = update.effective_user.id
         context.user_data["voice_id"] = DEFAULT_VOICE_ID
+        context.user_data["voice_name"] = DEFAULT_VOICE_NAME
         
         # Определяем текущий голос по умолчанию
-        current_voice = None
-        for key, voice_info in AVAILABLE_VOICES.items():
-            if voice_info["id"] == DEFAULT_VOICE_ID:
-                current_voice = voice_info
-                break
+        current_voice = VOICES_BY_ID.get(DEFAULT_VOICE_ID)
         
         if current_voice is None:
             current_voice = list(AVAILABLE_VOICES.values())[0]
         
-        welcome_message = (
-            "🎙️ Привет! Я бот для озвучивания текста на русском языке.\n\n"
-            "📝 Просто отправь мне текст на русском, и я преобразую его в речь с помощью ElevenLabs.\n"
-            f"🎤 Текущий голос: {current_voice['name']} - {current_voice['description']}\n"
-            f"⚠️ Максимальная длина текста: {MAX_TEXT_LENGTH} символов.\n\n"
-            "Используй команду /voice для выбора голоса\n"
-            "Используй команду /help для получения дополнительной информации."
+        welcome_message = self.WELCOME_TEMPLATE.format(
+            voice_name=current_voice["name"],
+            voice_description=current_voice["description"]
         )
         await update.message.reply_text(welcome_message)
     
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /help"""
-        help_message = (
-            "📖 Справка по использованию бота:\n\n"
-            "🔹 Команды:\n"
-            "/start - Начать работу с ботом\n"
-            "/help - Показать эту справку\n"
-            "/voice - Выбрать голос для озвучивания\n"
-            "/status - Проверить статус API\n\n"
-            "💡 Как использовать:\n"
-            "1. Выбери голос командой /voice (все голоса говорят на русском)\n"
-            "2. Отправь мне любой текст на русском языке\n"
-            "3. Я преобразую его в речь выбранным женским голосом\n"
-            "4. Получишь аудиофайл с озвучкой\n"
-            "5. Файл также сохранится локально на сервере\n\n"
-            f"⚠️ Ограничения: максимум {MAX_TEXT_LENGTH} символов за раз\n"
-            "🇷🇺 Все голоса поддерживают русский язык"
-        )
-        await update.message.reply_text(help_message)
+        await update.message.reply_text(self.HELP_MESSAGE)
     
     async def voice_selection(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /voice - выбор голоса"""
-        keyboard = []
-        row = []
-        
-        for i, (key, voice_info) in enumerate(AVAILABLE_VOICES.items()):
-            # Создаем кнопки по 2 в ряд
-            button_text = f"{voice_info['name']}\n{voice_info['description']}"
-            row.append(InlineKeyboardButton(button_text, callback_data=f"voice_{key}"))
-            
-            if len(row) == 2 or i == len(AVAILABLE_VOICES) - 1:
-                keyboard.append(row)
-                row = []
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
         current_voice_id = context.user_data.get("voice_id", DEFAULT_VOICE_ID)
-        current_voice_key = None
-        for key, voice_info in AVAILABLE_VOICES.items():
-            if voice_info["id"] == current_voice_id:
-                current_voice_key = key
-                break
+        current_voice = VOICES_BY_ID.get(current_voice_id)
         
-        if current_voice_key:
-            current_voice = AVAILABLE_VOICES[current_voice_key]
+        if current_voice:
             message = (
                 f"🎤 Выбери голос для озвучивания на русском языке:\n\n"
                 f"Текущий голос: **{current_voice['name']}** - {current_voice['description']}\n\n"
@@ -209,14 +251,14 @@ class TelegramTTSBot:
         else:
             message = f"🎤 Выбери голос для озвучивания на русском языке:\n\nДоступно {len(AVAILABLE_VOICES)} женских голосов с разными тонами (все говорят на русском):"
         
-        await update.message.reply_text(message, reply_markup=reply_markup, parse_mode="Markdown")
+        await update.message.reply_text(message, reply_markup=self._voice_keyboard, parse_mode="Markdown")
     
     async def voice_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик выбора голоса через inline кнопки"""
         query = update.callback_query
         await query.answer()
         
-        voice_key = query.data.replace("voice_", "")
+        voice_key = query.data.removeprefix("voice_")
         
         if voice_key not in AVAILABLE_VOICES:
             await query.edit_message_text("❌ Ошибка: выбранный голос не найден.")
@@ -224,6 +266,7 @@ class TelegramTTSBot:
         
         selected_voice = AVAILABLE_VOICES[voice_key]
         context.user_data["voice_id"] = selected_voice["id"]
+        context.user_data["voice_name"] = selected_voice["name"]
         
         success_message = (
             f"✅ Голос изменен!\n\n"
@@ -239,14 +282,12 @@ class TelegramTTSBot:
         """Обработчик команды /status - проверка статуса API"""
         try:
             tts = self.get_tts_instance(context)
-            is_valid = tts.is_valid_api_key()
+            # Проверка выполняется синхронно, поэтому выносим ее в отдельный поток,
+            # чтобы не блокировать обработку сообщений других пользователей
+            is_valid = await asyncio.to_thread(tts.is_valid_api_key)
             if is_valid:
                 current_voice_id = context.user_data.get("voice_id", DEFAULT_VOICE_ID)
-                current_voice = None
-                for voice_info in AVAILABLE_VOICES.values():
-                    if voice_info["id"] == current_voice_id:
-                        current_voice = voice_info
-                        break
+                current_voice = VOICES_BY_ID.get(current_voice_id)
                 
                 voice_info_text = f"\n🎤 Текущий голос: {current_voice['name']}" if current_voice else ""
                 status_message = (
@@ -290,31 +331,36 @@ class TelegramTTSBot:
             tts = self.get_tts_instance(context)
             
             # Генерация аудио
-            audio_path = tts.generate_speech(user_text)
+            audio, _ = await tts.generate_speech(user_text)
             
-            # Получаем информацию о текущем голосе для caption
-            current_voice_id = context.user_data.get("voice_id", DEFAULT_VOICE_ID)
-            current_voice_name = "Unknown"
-            for voice_info in AVAILABLE_VOICES.values():
-                if voice_info["id"] == current_voice_id:
-                    current_voice_name = voice_info["name"]
-                    break
+            # Имя текущего голоса для caption сохраняется при его выборе
+            current_voice_name = context.user_data.get("voice_name", DEFAULT_VOICE_NAME)
             
-            # Отправка аудиофайла пользователю
-            with open(audio_path, "rb") as audio_file:
-                await update.message.reply_voice(
-                    voice=audio_file,
-                    caption=f"🎵 Ваш текст озвучен голосом {current_voice_name}!\n📁 Файл: {audio_path.name}"
-                )
-            
-            # Удаление сообщения о обработке
-            await processing_message.delete()
+            # Отправка аудио пользователю прямо из памяти и удаление сообщения
+            # о обработке выполняются параллельно
+            send_result, delete_result = await asyncio.gather(
+                update.message.reply_voice(
+                    voice=audio,
+                    filename=f"voice_{update.effective_user.id}.mp3",
+                    caption=f"🎵 Ваш текст озвучен голосом {current_voice_name}!"
+                ),
+                processing_message.delete(),
+                return_exceptions=True
+            )
+            if isinstance(send_result, Exception):
+                raise send_result
+            if isinstance(delete_result, Exception):
+                logger.warning(f"Не удалось удалить сообщение о обработке: {delete_result}")
             
             logger.info(f"Успешно обработан текст от пользователя {update.effective_user.id}")
             
         except Exception as e:
             error_message = f"❌ Ошибка при генерации аудио: {str(e)}"
-            await processing_message.edit_text(error_message)
+            try:
+                await processing_message.edit_text(error_message)
+            except Exception:
+                # Сообщение о обработке могло быть уже удалено
+                await update.message.reply_text(error_message)
             logger.error(f"Ошибка при обработке текста: {e}")
     
     def run(self):
@@ -324,7 +370,6 @@ class TelegramTTSBot:
         # Callback для установки команд после инициализации
         async def post_init(application: Application):
             # Устанавливаем команды в фоне, не блокируя запуск
-            import asyncio
             try:
                 # Небольшая задержка для полной инициализации
                 await asyncio.sleep(1)
@@ -332,11 +377,16 @@ class TelegramTTSBot:
             except Exception as e:
                 logger.warning(f"Не удалось установить команды при запуске: {e}, бот продолжит работу")
         
-        # Создание приложения с post_init callback
+        # Callback для освобождения ресурсов при остановке бота
+        async def post_shutdown(application: Application):
+            await close_http_client()
+        
+        # Создание приложения с post_init и post_shutdown callback
         application = (
             Application.builder()
             .token(TELEGRAM_BOT_TOKEN)
             .post_init(post_init)
+            .post_shutdown(post_shutdown)
             .build()
         )
         
@@ -1,11 +1,17 @@
 """
 Модуль для работы с ElevenLabs Text-to-Speech API
 """
-import requests
+import asyncio
+import httpx
+import hashlib
 import json
 import logging
+import os
+import time
+from functools import lru_cache
+from io import BytesIO
 from pathlib import Path
-from datetime import datetime
+from typing import Optional, Tuple
 from config import (
     ELEVENLABS_API_KEY,
     ELEVENLABS_API_URL,
@@ -13,152 +19,312 @@ from config import (
     DEFAULT_VOICE_ID,
     VOICE_SETTINGS,
     TTS_MODEL,
-    AUDIO_DIR
+    AUDIO_DIR,
+    AUDIO_CACHE_MAX_FILES
 )
 
 logger = logging.getLogger(__name__)
 
+# Неизменная часть тела запроса (модель и настройки голоса) сериализуется один раз
+# Модель eleven_multilingual_v2 автоматически определяет язык (включая русский)
+_STATIC_BODY = json.dumps({
+    "model_id": TTS_MODEL,
+    "voice_settings": VOICE_SETTINGS
+}, ensure_ascii=False).encode()[1:-1]
+
+# Неизменная часть ключа кэша: модель и настройки голоса
+_CACHE_KEY_SUFFIX = f"{TTS_MODEL}|{json.dumps(VOICE_SETTINGS, sort_keys=True)}"
+
+# Результат последней проверки API ключа и время ее выполнения (time.monotonic)
+# Ключ меняется редко, поэтому результат переиспользуется в течение API_KEY_CHECK_TTL секунд
+API_KEY_CHECK_TTL = 300
+_KEY_CHECK = {"ok": None, "ts": 0.0}
+
+# Возраст (в секундах), после которого временный файл считается брошенным
+# (процесс упал между записью и переименованием) и удаляется при очистке кэша
+STALE_TMP_AGE = 3600
+
+# Ссылки на фоновые задачи сохранения файлов, чтобы их не собрал сборщик мусора
+_BACKGROUND_TASKS = set()
+
+# Асинхронный клиент для генерации речи: не блокирует event loop бота
+# и переиспользует соединения с api.elevenlabs.io между запросами
+_ACLIENT = httpx.AsyncClient(
+    http2=True,
+    timeout=30,
+    headers={"xi-api-key": ELEVENLABS_API_KEY}
+)
+
+
+def _cache_key(text: str, voice_id: str) -> str:
+    """Вычисляет ключ кэша для текста, голоса и текущих настроек генерации"""
+    return hashlib.sha256(f"{voice_id}|{_CACHE_KEY_SUFFIX}|{text}".encode()).hexdigest()
+
+
+def _read_cached_audio(filepath: Path) -> Optional[bytes]:
+    """Читает аудио из кэша и обновляет время доступа к файлу (None, если файла нет или он не читается)"""
+    try:
+        data = filepath.read_bytes()
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        # Поврежденная запись кэша считается промахом: аудио будет сгенерировано заново
+        logger.warning(f"Не удалось прочитать аудио из кэша {filepath}: {e}")
+        return None
+    
+    # Неудачное обновление времени доступа не должно отменять попадание в кэш
+    try:
+        os.utime(filepath)
+    except OSError as e:
+        logger.warning(f"Не удалось обновить время доступа к {filepath}: {e}")
+    return data
+
+
+def _evict_old_audio():
+    """
+    Удаляет самые старые аудиофайлы, если их больше AUDIO_CACHE_MAX_FILES,
+    а также брошенные временные файлы старше STALE_TMP_AGE
+    """
+    # Время изменения собирается сразу при обходе: параллельная очистка
+    # из другого потока может удалить файл между scandir и stat
+    files = []
+    stale_tmp = []
+    stale_before = time.time() - STALE_TMP_AGE
+    with os.scandir(AUDIO_DIR) as entries:
+        for entry in entries:
+            is_mp3 = entry.name.endswith(".mp3")
+            if not is_mp3 and not entry.name.endswith(".tmp"):
+                continue
+            try:
+                if not entry.is_file():
+                    continue
+                mtime = entry.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            if is_mp3:
+                files.append((mtime, entry.path))
+            elif mtime < stale_before:
+                stale_tmp.append(entry.path)
+    
+    for path in stale_tmp:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+    if stale_tmp:
+        logger.info(f"Удалено брошенных временных файлов: {len(stale_tmp)}")
+    
+    excess = len(files) - AUDIO_CACHE_MAX_FILES
+    if excess <= 0:
+        return
+    
+    files.sort()
+    removed = 0
+    for _, path in files[:excess]:
+        try:
+            os.unlink(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    logger.info(f"Удалено старых аудиофайлов из кэша: {removed}")
+
+
+def _write_audio_file(data: bytes, filepath: Path):
+    """Атомарно записывает аудиофайл и ограничивает размер кэша"""
+    # Запись через временный файл, чтобы читатели кэша не увидели недописанный mp3
+    tmp_path = filepath.with_name(f"{filepath.name}.{time.time_ns()}.tmp")
+    try:
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, filepath)
+    except OSError:
+        # Недописанный временный файл удаляем сразу, не дожидаясь очистки кэша
+        tmp_path.unlink(missing_ok=True)
+        raise
+    
+    # Ошибка очистки кэша не означает ошибку сохранения, поэтому логируется отдельно
+    try:
+        _evict_old_audio()
+    except OSError as e:
+        logger.warning(f"Не удалось очистить кэш аудиофайлов: {e}")
+
+
+def _save_audio_in_background(data: bytes, filepath: Path):
+    """Сохраняет аудиофайл на диск в фоновом потоке, не задерживая ответ пользователю"""
+    def on_done(task: asyncio.Task):
+        _BACKGROUND_TASKS.discard(task)
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            logger.error(f"Не удалось сохранить аудиофайл {filepath}: {task.exception()}")
+        else:
+            logger.info(f"Аудиофайл успешно сохранен: {filepath}")
+    
+    task = asyncio.create_task(asyncio.to_thread(_write_audio_file, data, filepath))
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(on_done)
+
+
+async def close_http_client():
+    """Закрывает асинхронный HTTP-клиент и его пул соединений (вызывается при остановке бота)"""
+    await _ACLIENT.aclose()
+
+
+@lru_cache(maxsize=None)
+def _get_session():
+    """
+    Возвращает синхронную HTTP-сессию для проверки API ключа
+    
+    requests импортируется только при первом обращении, чтобы не замедлять запуск бота.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    
+    session = requests.Session()
+    session.headers.update({"xi-api-key": ELEVENLABS_API_KEY})
+    session.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=20))
+    return session
+
+
+@lru_cache(maxsize=32)
+def _voice_api_url(voice_id: str) -> str:
+    """Возвращает URL эндпоинта генерации речи для голоса (кэшируется)"""
+    return f"{ELEVENLABS_API_URL}/{voice_id}"
+
 
 class ElevenLabsTTS:
     """Класс для генерации речи через ElevenLabs API"""
     
     def __init__(self, voice_id: str = None):
-        self.api_key = ELEVENLABS_API_KEY
         self.voice_id = voice_id or DEFAULT_VOICE_ID
-        self.api_url = f"{ELEVENLABS_API_URL}/{self.voice_id}"
-        self.headers = {
-            "Accept": "audio/mpeg",
-            "Content-Type": "application/json",
-            "xi-api-key": self.api_key
-        }
+        self.api_url = _voice_api_url(self.voice_id)
     
     def set_voice(self, voice_id: str):
         """Устанавливает ID голоса для генерации"""
         self.voice_id = voice_id
-        self.api_url = f"{ELEVENLABS_API_URL}/{self.voice_id}"
+        self.api_url = _voice_api_url(self.voice_id)
     
-    def generate_speech(self, text: str) -> Path:
+    async def generate_speech(self, text: str) -> Tuple[BytesIO, Path]:
         """
-        Генерирует аудиофайл из текста на русском языке
+        Генерирует аудио из текста на русском языке
+        
+        Аудио возвращается в памяти для немедленной отправки, а копия
+        сохраняется в AUDIO_DIR в фоне. Файлы именуются хэшем текста, голоса
+        и настроек, поэтому повторный запрос того же текста берется с диска
+        без обращения к API.
         
         Args:
             text: Текст для озвучивания (поддерживается русский язык)
             
         Returns:
-            Path: Путь к сохраненному аудиофайлу
+            Tuple[BytesIO, Path]: Буфер с mp3 и путь, по которому сохраняется файл
             
         Raises:
             Exception: При ошибке API или сохранения файла
         """
         try:
-            # Подготовка данных для запроса
-            # Модель eleven_multilingual_v2 автоматически определяет язык (включая русский)
-            data = {
-                "text": text,
-                "model_id": TTS_MODEL,  # Мультиязычная модель с поддержкой русского
-                "voice_settings": VOICE_SETTINGS
-            }
+            filepath = AUDIO_DIR / f"{_cache_key(text, self.voice_id)}.mp3"
+            
+            # Проверка кэша: такой текст этим голосом уже озвучивался
+            cached = await asyncio.to_thread(_read_cached_audio, filepath)
+            if cached is not None:
+                logger.info(f"Аудио найдено в кэше: {filepath}")
+                return BytesIO(cached), filepath
+            
+            # Подготовка данных для запроса: сериализуется только текст
+            body = b'{"text":' + json.dumps(text, ensure_ascii=False).encode() + b',' + _STATIC_BODY + b'}'
             
             logger.info(f"Отправка запроса в ElevenLabs API для текста длиной {len(text)} символов (русский язык), голос ID: {self.voice_id}")
             
             # Отправка запроса
-            response = requests.post(
+            response = await _ACLIENT.post(
                 self.api_url,
-                json=data,
-                headers=self.headers,
-                timeout=30
+                content=body,
+                headers={"Accept": "audio/mpeg", "Content-Type": "application/json"}
             )
             
             # Проверка статуса ответа
             response.raise_for_status()
             
-            # Генерация имени файла
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"voice_{timestamp}.mp3"
-            filepath = AUDIO_DIR / filename
+            # Тело ответа уже прочитано в response.content; BytesIO разделяет этот буфер,
+            # пока в него не пишут, поэтому отправка и фоновое сохранение не копируют mp3
+            data = response.content
             
-            # Сохранение аудиофайла
-            with open(filepath, "wb") as f:
-                f.write(response.content)
+            # Сохранение аудиофайла в фоне
+            _save_audio_in_background(data, filepath)
             
-            logger.info(f"Аудиофайл успешно сохранен: {filepath}")
-            return filepath
+            return BytesIO(data), filepath
             
-        except requests.exceptions.HTTPError as e:
+        except httpx.HTTPStatusError as e:
             # Обработка HTTP ошибок с детальным сообщением
-            error_message = "Ошибка при обращении к ElevenLabs API"
-            
-            if hasattr(e, 'response') and e.response is not None:
-                status_code = e.response.status_code
-                try:
-                    error_data = e.response.json()
-                    detail = error_data.get('detail', {})
-                    
-                    if isinstance(detail, dict):
-                        api_message = detail.get('message', '')
-                        api_status = detail.get('status', '')
-                        
-                        if 'unusual_activity' in api_status.lower() or 'free tier' in api_message.lower():
-                            error_message = (
-                                "⚠️ Проблема с аккаунтом ElevenLabs:\n"
-                                "Обнаружена необычная активность или бесплатный тариф заблокирован.\n"
-                                "Проверьте ваш аккаунт на сайте elevenlabs.io"
-                            )
-                        elif status_code == 401:
-                            error_message = (
-                                "🔑 Ошибка авторизации:\n"
-                                "Неверный API ключ ElevenLabs.\n"
-                                "Проверьте ELEVENLABS_API_KEY в файле .env"
-                            )
-                        elif status_code == 403:
-                            error_message = (
-                                "🚫 Доступ запрещен (403):\n"
-                                "Ваш API ключ не имеет доступа к этому ресурсу.\n\n"
-                                "Возможные причины:\n"
-                                "• Аккаунт заблокирован или ограничен\n"
-                                "• Исчерпан лимит бесплатного тарифа\n"
-                                "• Проблемы с регионом/IP адресом\n"
-                                "• Требуется платная подписка\n\n"
-                                "Проверьте статус аккаунта на elevenlabs.io"
-                            )
-                        elif status_code == 429:
-                            error_message = (
-                                "⏱️ Превышен лимит запросов:\n"
-                                "Слишком много запросов к API.\n"
-                                "Подождите немного и попробуйте снова"
-                            )
-                        else:
-                            error_message = f"Ошибка API (код {status_code}): {api_message}"
-                    else:
-                        error_message = f"Ошибка API: {str(detail)}"
-                        
-                except (json.JSONDecodeError, KeyError, AttributeError):
-                    # Если не удалось распарсить JSON, используем текст ответа
-                    error_text = e.response.text[:200] if hasattr(e.response, 'text') else str(e)
-                    logger.error(f"Ответ API (не JSON): {error_text}")
-                    if status_code == 401:
-                        error_message = "🔑 Ошибка авторизации: проверьте API ключ в .env файле"
-                    elif status_code == 403:
-                        error_message = (
-                            "🚫 Доступ запрещен (403):\n"
-                            "Проверьте статус аккаунта на elevenlabs.io\n"
-                            "Возможно, требуется платная подписка или аккаунт заблокирован"
-                        )
-                    elif status_code == 429:
-                        error_message = "⏱️ Превышен лимит запросов. Подождите и попробуйте снова"
-                    else:
-                        error_message = f"Ошибка API (код {status_code})"
+            # Тело ответа декодируется и разбирается только один раз
+            response = e.response
+            status_code = response.status_code
+            body = response.text
+            try:
+                detail = json.loads(body).get('detail', {})
+            except (ValueError, AttributeError):
+                detail = None
             
-            # Логируем детали ошибки для отладки
-            if hasattr(e, 'response') and e.response is not None:
-                logger.error(f"Ошибка при запросе к ElevenLabs API (код {e.response.status_code}): {e}")
-                if hasattr(e.response, 'text'):
-                    logger.error(f"Полный ответ API: {e.response.text}")
+            if detail is None:
+                # Если не удалось распарсить JSON, используем текст ответа
+                logger.error(f"Ответ API (не JSON): {body[:200]}")
+                if status_code == 401:
+                    error_message = "🔑 Ошибка авторизации: проверьте API ключ в .env файле"
+                elif status_code == 403:
+                    error_message = (
+                        "🚫 Доступ запрещен (403):\n"
+                        "Проверьте статус аккаунта на elevenlabs.io\n"
+                        "Возможно, требуется платная подписка или аккаунт заблокирован"
+                    )
+                elif status_code == 429:
+                    error_message = "⏱️ Превышен лимит запросов. Подождите и попробуйте снова"
+                else:
+                    error_message = f"Ошибка API (код {status_code})"
+            elif isinstance(detail, dict):
+                # Поля могут прийти как null или не строкой
+                api_message = str(detail.get('message') or '')
+                api_status = str(detail.get('status') or '')
+                
+                if 'unusual_activity' in api_status.lower() or 'free tier' in api_message.lower():
+                    error_message = (
+                        "⚠️ Проблема с аккаунтом ElevenLabs:\n"
+                        "Обнаружена необычная активность или бесплатный тариф заблокирован.\n"
+                        "Проверьте ваш аккаунт на сайте elevenlabs.io"
+                    )
+                elif status_code == 401:
+                    error_message = (
+                        "🔑 Ошибка авторизации:\n"
+                        "Неверный API ключ ElevenLabs.\n"
+                        "Проверьте ELEVENLABS_API_KEY в файле .env"
+                    )
+                elif status_code == 403:
+                    error_message = (
+                        "🚫 Доступ запрещен (403):\n"
+                        "Ваш API ключ не имеет доступа к этому ресурсу.\n\n"
+                        "Возможные причины:\n"
+                        "• Аккаунт заблокирован или ограничен\n"
+                        "• Исчерпан лимит бесплатного тарифа\n"
+                        "• Проблемы с регионом/IP адресом\n"
+                        "• Требуется платная подписка\n\n"
+                        "Проверьте статус аккаунта на elevenlabs.io"
+                    )
+                elif status_code == 429:
+                    error_message = (
+                        "⏱️ Превышен лимит запросов:\n"
+                        "Слишком много запросов к API.\n"
+                        "Подождите немного и попробуйте снова"
+                    )
+                else:
+                    error_message = f"Ошибка API (код {status_code}): {api_message}"
             else:
-                logger.error(f"Ошибка при запросе к ElevenLabs API: {e}")
+                error_message = f"Ошибка API: {str(detail)}"
+            
+            # Логируем детали ошибки для отладки
+            logger.error(f"Ошибка при запросе к ElevenLabs API (код {status_code}): {e}")
+            logger.error(f"Полный ответ API: {body}")
             raise Exception(error_message)
             
-        except requests.exceptions.RequestException as e:
+        except httpx.RequestError as e:
             logger.error(f"Ошибка сети при запросе к ElevenLabs API: {e}")
             raise Exception("🌐 Ошибка сети: не удалось подключиться к ElevenLabs API. Проверьте интернет-соединение.")
             
@@ -170,21 +336,30 @@ class ElevenLabsTTS:
         """
         Проверяет валидность API ключа
         
+        Однозначный ответ API (200 или 401) кэшируется на API_KEY_CHECK_TTL секунд;
+        сетевые ошибки и прочие статусы не кэшируются.
+        
         Returns:
             bool: True если ключ валиден
         """
+        if _KEY_CHECK["ok"] is not None and time.monotonic() - _KEY_CHECK["ts"] < API_KEY_CHECK_TTL:
+            return _KEY_CHECK["ok"]
+        
+        import requests
+        
         try:
             # Простой запрос для проверки ключа
-            response = requests.get(
+            response = _get_session().get(
                 "https://api.elevenlabs.io/v1/user",
-                headers={"xi-api-key": self.api_key},
                 timeout=10
             )
             
             if response.status_code == 200:
+                _KEY_CHECK.update(ok=True, ts=time.monotonic())
                 return True
             elif response.status_code == 401:
                 logger.warning("API ключ ElevenLabs недействителен (401)")
+                _KEY_CHECK.update(ok=False, ts=time.monotonic())
                 return False
             else:
                 logger.warning(f"Неожиданный статус при проверке API ключа: {response.status_code}")